@@ -11,185 +11,508 @@ Usage:
 """
 
 import argparse
+import fnmatch
+import functools
+import hashlib
 import json
 import os
-import shlex
 import subprocess
 import sys
+import time
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
+
+try:  # optional: faster C parser for the config
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Required config keys (QM keys only when level_of_theory != MM)
+_BASE_KEYS = frozenset({
+    "directory", "complex_residues", "receptor_residues", "ligand_residues",
+    "level_of_theory", "startframe", "endframe", "interval",
+    "igb", "saltcon", "submit_job",
+})
+_QM_KEYS = frozenset({"qm_residues", "qmcharge_com", "qmcharge_rec", "qmcharge_lig"})
+
+# String spellings accepted as true by coerce_bool (and as false by compress_level)
+_TRUE_STRINGS = frozenset({"1", "true", "yes", "y", "t"})
+_FALSE_STRINGS = frozenset({"0", "false", "no", "n", "f", ""})
+
+# Warn when the stripped trajectory would hold more frames than this
+_FRAME_WARN_THRESHOLD = 10000
 
 # ---------------------------
 # Utilities
 # ---------------------------
 
-def run(cmd, cwd=None):
-    """Run a shell command, raising on failure and echoing the command."""
-    print(f"[run] {cwd or os.getcwd()}$ {cmd}")
-    subprocess.run(shlex.split(cmd), cwd=cwd, check=True)
+def _launch_argv(argv: List[str], cwd=None) -> List[str]:
+    """Echo the command and return argv with argv[0] resolved to its cached absolute path."""
+    print(f"[run] {cwd or os.getcwd()}$ {' '.join(argv)}")
+    # Exec the cached absolute path so the child launch doesn't re-walk PATH.
+    return [_which(argv[0]) or argv[0]] + list(argv[1:])
+
+def run_argv(argv: List[str], cwd=None, **kwargs):
+    """
+    Run a command (argv list), raising on failure and echoing the command.
+    Extra kwargs (e.g. stdout=subprocess.PIPE) go to subprocess.run.
+    """
+    # close_fds=False skips the inherited-fd sweep; we hold no fds the child
+    # could misuse. With cwd=None as well, CPython uses posix_spawn.
+    return subprocess.run(_launch_argv(argv, cwd), cwd=cwd, check=True, close_fds=False, **kwargs)
+
+def run_parallel(tasks):
+    """
+    Run independent (argv, cwd, on_success) tasks concurrently; on_success
+    (or None) is called as soon as its own task exits zero. As soon as one
+    exits non-zero, the others still running are terminated and
+    CalledProcessError is raised for the failed one.
+    """
+    procs = [subprocess.Popen(_launch_argv(argv, cwd), cwd=cwd, close_fds=False)
+             for argv, cwd, _ in tasks]
+    try:
+        running = list(zip(procs, [on_success for _, _, on_success in tasks]))
+        while running:
+            for item in list(running):
+                proc, on_success = item
+                rc = proc.poll()
+                if rc is None:
+                    continue
+                running.remove(item)
+                if rc != 0:
+                    raise subprocess.CalledProcessError(rc, proc.args)
+                if on_success is not None:
+                    on_success()
+            if running:
+                time.sleep(0.1)
+    finally:
+        # Reached with live siblings only on failure (or Ctrl-C)
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs:
+            proc.wait()
+    return procs
+
+@functools.lru_cache(maxsize=None)
+def _which(name: str):
+    """Cached shutil.which; PATH is walked at most once per command."""
+    from shutil import which
+    return which(name)
 
 def ensure_cmd(name: str):
     """Check that a command exists in PATH."""
-    from shutil import which
-    if which(name) is None:
+    if _which(name) is None:
         raise RuntimeError(f"Required command '{name}' not found in PATH.")
 
+def _write_bytes(path: Path, data: bytes):
+    """Write bytes with a raw fd, bypassing the buffered text-IO layer."""
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def _submit_sbatch(script: str, cwd: Path) -> int:
+    """Submit with `sbatch --parsable` and return the job id (stdout is "<id>[;<cluster>]")."""
+    result = run_argv(["sbatch", "--parsable", script], cwd=cwd,
+                      stdout=subprocess.PIPE, universal_newlines=True)
+    return int(result.stdout.strip().split(";")[0])
+
+def cpptraj_argv(in_name: str, nprocs: int = 1) -> List[str]:
+    """argv for a cpptraj session; uses cpptraj.MPI under mpirun when available and nprocs > 1."""
+    if nprocs > 1 and _which("cpptraj.MPI") and _which("mpirun"):
+        return ["mpirun", "-np", str(nprocs), "cpptraj.MPI", "-i", in_name]
+    return ["cpptraj", "-i", in_name]
+
+def drop_page_cache(path: Path):
+    """Advise the kernel to evict path's cached pages (Linux; silently a no-op elsewhere)."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fdatasync(fd)  # dirty pages are not evicted until written back
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def compress_level(x) -> int:
+    """
+    zlib level (0-9) from a traj_compress config value. Booleans and their
+    string spellings map to 0/1; integers (or integer strings) give the level.
+    """
+    if x is None or x is True or x is False:
+        return int(bool(x))
+    if isinstance(x, str):
+        text = x.strip().lower()
+        if text.isdigit():
+            level = int(text)
+        elif text in _TRUE_STRINGS:
+            return 1
+        elif text in _FALSE_STRINGS:
+            return 0
+        else:
+            level = -1
+    elif isinstance(x, int) or (isinstance(x, float) and x.is_integer()):
+        level = int(x)
+    else:
+        level = -1
+    if not 0 <= level <= 9:
+        raise ValueError(f"traj_compress must be a boolean or an integer level 0-9, got {x!r}")
+    return level
+
 def coerce_bool(x) -> bool:
-    if isinstance(x, bool):
+    if x is True or x is False:
         return x
+    if isinstance(x, str):
+        return x.strip().lower() in _TRUE_STRINGS
     if isinstance(x, (int, float)):
         return bool(x)
-    if isinstance(x, str):
-        return x.strip().lower() in {"1", "true", "yes", "y", "t"}
     return False
 
-def require_keys(d: Dict[str, Any], keys):
-    missing = [k for k in keys if k not in d]
+def pick_single_file(sim_dir: Path, pattern: str) -> Path:
+    """Return the one entry in sim_dir matching pattern; stop scanning at a second match."""
+    hit = None
+    with os.scandir(sim_dir) as it:
+        for entry in it:
+            if fnmatch.fnmatch(entry.name, pattern) and entry.is_file():
+                if hit is not None:
+                    raise RuntimeError(
+                        f"Multiple files match {pattern} in {sim_dir} "
+                        f"(e.g. {Path(hit).name}, {entry.name}); keep exactly one.")
+                hit = entry.path
+    if hit is None:
+        raise FileNotFoundError(f"No file matching {pattern} in {sim_dir}")
+    return Path(hit)
+
+def strip_expr(residue_mask: str) -> str:
+    """cpptraj expression stripping everything outside residue_mask, e.g. '!(:1-723)'."""
+    return sys.intern(f"!(:{residue_mask})")
+
+def expected_frames(start: int, end: int, interval: int) -> Optional[int]:
+    """
+    Number of frames cpptraj reads for `trajin <nc> start end interval` (1-based, inclusive).
+    Returns None for end == -1 (cpptraj: through the last frame), where the count is unknown.
+    """
+    if interval < 1:
+        raise ValueError(f"interval must be >= 1, got {interval}")
+    if end == -1:
+        return None
+    if end < start:
+        raise ValueError(f"endframe ({end}) is before startframe ({start})")
+    return (end - start) // interval + 1
+
+def require_keys(d: Dict[str, Any], keys: frozenset):
+    missing = keys.difference(d)
     if missing:
-        raise KeyError(f"Missing required config key(s): {', '.join(missing)}")
+        raise KeyError(f"Missing required config key(s): {', '.join(sorted(missing))}")
 
 # ---------------------------
-# Writers
+# Freshness stamps (skip cpptraj when nothing changed)
 # ---------------------------
 
-def write_cpptraj_prmtop_in(out_path: Path, source_prmtop_glob: str, residue_mask: str, out_prmtop: str):
-    """
-    Write a cpptraj input that loads the source parm, strips to residue_mask,
-    removes box info, and writes the stripped topology.
-    """
-    text = f"""parm {source_prmtop_glob}
-parmstrip !(:{residue_mask})
-parmbox nobox
-parmwrite out {out_prmtop}
-run
-quit
+def _stamp_path(in_path: Path) -> Path:
+    return in_path.with_name(f".{in_path.stem}.stamp")
+
+def _stamp_digest(in_path: Path, sources) -> str:
+    """sha256 of the rendered cpptraj input plus (path, mtime_ns, size) of each source."""
+    h = hashlib.sha256(in_path.read_bytes())
+    for src in sources:
+        st = os.stat(src)
+        h.update(f"\0{src}\0{st.st_mtime_ns}\0{st.st_size}".encode())
+    return h.hexdigest()
+
+def is_up_to_date(in_path: Path, sources, outputs) -> bool:
+    """True if every output exists and the stamp matches the current input and sources."""
+    stamp = _stamp_path(in_path)
+    if not stamp.exists() or not all(Path(o).exists() for o in outputs):
+        return False
+    return stamp.read_text().strip() == _stamp_digest(in_path, sources)
+
+def clear_stamp(in_path: Path):
+    try:
+        _stamp_path(in_path).unlink()
+    except FileNotFoundError:
+        pass
+
+def write_stamp(in_path: Path, sources):
+    _write_bytes(_stamp_path(in_path), (_stamp_digest(in_path, sources) + "\n").encode())
+
+# ---------------------------
+# Templates (rendered with str.format_map)
+# ---------------------------
+
+_CPPTRAJ_PARM_TMPL = "parm {source_prmtop} [{tag}]\n"
+
+_CPPTRAJ_PARMSTRIP_TMPL = """parmstrip {strip_expr} parm [{tag}]
+parmbox nobox parm [{tag}]
+parmwrite out {out_dir}/{tag}.prmtop parm [{tag}]
 """
-    out_path.write_text(text)
 
-def write_cpptraj_striptraj_in(out_path: Path, source_prmtop_glob: str,
-                               source_nc: str, residue_mask: str,
-                               start: int, end: int, interval: int,
-                               out_nc: str):
-    """
-    Write a cpptraj input that loads parm, reads trajectory frames with range/interval,
-    autoimages, strips to residue_mask, and writes a boxless trajectory.
-    """
-    # cpptraj trajin syntax: trajin <file> [start [stop [offset]]]
-    text = f"""parm {source_prmtop_glob}
+# cpptraj trajin syntax: trajin <file> [start [stop [offset]]]
+_CPPTRAJ_STRIPTRAJ_TMPL = """{frames_comment}parm {source_prmtop}
 trajin {source_nc} {start} {end} {interval}
 autoimage
-strip !(:{residue_mask})
-trajout {out_nc} nobox
+strip {strip_expr}
+trajout {out_nc} netcdf nobox{compress}
 run
 quit
 """
-    out_path.write_text(text)
-
-def write_mmgbsa_input(out_path: Path, data: Dict[str, Any]):
-    """
-    Write MMPBSA input file for MM or QM/MM based on level_of_theory.
-    Uses the same shape as the user's original template.
-    """
-    level = str(data["level_of_theory"]).upper()
-
-    header = (
-        "Input file for running MM-GBSA\n"
-        if level == "MM" else
-        "Input file for running QMMM-GBSA\n"
-    )
 
-    # &general block
-    general = (
-        f"""&general
+_MMGBSA_TMPL = """Input file for running {kind}-GBSA
+&general
    verbose=1,
    keep_files=0,
-   receptor_mask=:{data["receptor_residues"]},
-   ligand_mask=:{data["ligand_residues"]},
+   receptor_mask=:{receptor_residues},
+   ligand_mask=:{ligand_residues},
 /
+&gb
+   igb={igb},
+   saltcon={saltcon},
+{qm_block}/
 """
-    )
 
-    # &gb block (with or without QM params)
-    if level == "MM":
-        gb = f"""&gb
-   igb={data["igb"]},
-   saltcon={data["saltcon"]},
-/
+# Keep the user's original keys/shape for QM flags
+_MMGBSA_QM_TMPL = """   ifqnt=1,
+   qm_theory="{level_of_theory}",
+   qm_residues="{qm_residues}",
+   qmcharge_com={qmcharge_com},
+   qmcharge_rec={qmcharge_rec},
+   qmcharge_lig={qmcharge_lig},
 """
-    else:
-        # Keep the user's original keys/shape for QM flags
-        gb = f"""&gb
-   igb={data["igb"]},
-   saltcon={data["saltcon"]},
-   ifqnt=1,
-   qm_theory="{data["level_of_theory"]}",
-   qm_residues="{data["qm_residues"]}",
-   qmcharge_com={data["qmcharge_com"]},
-   qmcharge_rec={data["qmcharge_rec"]},
-   qmcharge_lig={data["qmcharge_lig"]},
-/
-"""
-    out_path.write_text(header + general + gb)
 
-def write_slurm_job(out_path: Path, job_name: str, nprocs: int):
+# SLURM script template: packaged default, overridable with "slurm_template".
+# Rendered with str.format_map, so literal braces must be doubled ({{ }}).
+_TEMPLATE_DIR = Path(__file__).resolve().parent / "templates"
+_SLURM_TEMPLATE = _TEMPLATE_DIR / "submit.job.tmpl"
+_SLURM_DEFAULTS = {
+    "slurm_partition": "production",
+    "slurm_mem": "64G",
+    "slurm_time": "1-00:00:00",
+    "slurm_account": "yang_lab",
+    "amber_env": "/home/shaoq1/bin/amber_env/amber-accre.sh",
+}
+
+@functools.lru_cache(maxsize=None)
+def _load_template(path: Path) -> str:
+    return path.read_text()
+
+# ---------------------------
+# Writers
+# ---------------------------
+
+def write_cpptraj_all_prmtops_in(out_path: Path, source_prmtop: str,
+                                 complex_strip: str, receptor_strip: str, ligand_strip: str,
+                                 out_dir: str = "."):
+    """
+    Write a single cpptraj input that loads the source parm once per tag
+    (complex/receptor/ligand), strips each copy with its strip expression
+    (see strip_expr), removes box info, and writes the three stripped
+    topologies (<out_dir>/<tag>.prmtop) in one session.
+    """
+    tags = (
+        ("complex", complex_strip),
+        ("receptor", receptor_strip),
+        ("ligand", ligand_strip),
+    )
+    text = "".join(
+        [_CPPTRAJ_PARM_TMPL.format(source_prmtop=source_prmtop, tag=tag) for tag, _ in tags]
+        + [_CPPTRAJ_PARMSTRIP_TMPL.format(strip_expr=expr, tag=tag, out_dir=out_dir)
+           for tag, expr in tags]
+        + ["run\nquit\n"]
+    )
+    _write_bytes(out_path, text.encode())
+
+def write_cpptraj_striptraj_in(out_path: Path, source_prmtop: str,
+                               source_nc: str, strip: str,
+                               start: int, end: int, interval: int,
+                               out_nc: str, compress: int = 0):
+    """
+    Write a cpptraj input that loads parm, reads trajectory frames with range/interval,
+    autoimages, applies the strip expression, and writes a boxless NetCDF trajectory.
+    compress > 0 writes NetCDF4 with lossless zlib compression at that level.
+    """
+    nframes = expected_frames(start, end, interval)
+    text = _CPPTRAJ_STRIPTRAJ_TMPL.format(
+        frames_comment="" if nframes is None else f"# expected frames: {nframes}\n",
+        source_prmtop=source_prmtop,
+        source_nc=source_nc,
+        strip_expr=strip,
+        start=start, end=end, interval=interval,
+        out_nc=out_nc,
+        compress=f" compress {compress}" if compress else "",
+    )
+    _write_bytes(out_path, text.encode())
+
+def write_mmgbsa_input(out_path: Path, data: Dict[str, Any]):
+    """
+    Write MMPBSA input file for MM or QM/MM based on level_of_theory.
+    Uses the same shape as the user's original template.
+    """
+    mm = str(data["level_of_theory"]).upper() == "MM"
+    text = _MMGBSA_TMPL.format_map(dict(
+        data,
+        kind="MM" if mm else "QMMM",
+        qm_block="" if mm else _MMGBSA_QM_TMPL.format_map(data),
+    ))
+    _write_bytes(out_path, text.encode())
+
+def write_slurm_job(out_path: Path, job_name: str, nprocs: int, data: Dict[str, Any],
+                    config_dir: Path = Path(".")):
     """
     Write a SLURM script that runs MMPBSA.py.MPI with the prepared inputs.
     Assumes this script lives inside the mmgbsa work dir and that inputs are one dir up.
+    Resources come from the optional slurm_* / amber_env config keys, and the
+    template itself can be replaced via "slurm_template" (relative paths are
+    resolved against config_dir, the directory of the JSON config).
     """
-    text = f"""#!/bin/bash
-#SBATCH --nodes=1
-#SBATCH --job-name={job_name}
-#SBATCH --partition=production
-#SBATCH --ntasks={nprocs}
-#SBATCH --mem=64G
-#SBATCH --time=1-00:00:00
-#SBATCH --account=yang_lab
-
-set -euo pipefail
-
-source /home/shaoq1/bin/amber_env/amber-accre.sh
-
-echo "[$(date)] Running MMPBSA.py.MPI..."
-mpirun -np {nprocs} "$AMBERHOME/bin/MMPBSA.py.MPI" -O \\
-  -i ./*.in \\
-  -cp ../complex.prmtop \\
-  -rp ../receptor.prmtop \\
-  -lp ../ligand.prmtop \\
-  -y ../md.nc \\
-  > progress.log 2>&1
-
-echo "[$(date)] Done."
-"""
-    out_path.write_text(text)
+    opts = dict(_SLURM_DEFAULTS)
+    opts.update((k, data[k]) for k in _SLURM_DEFAULTS if k in data)
+    template = _SLURM_TEMPLATE
+    if "slurm_template" in data:
+        template = config_dir / Path(data["slurm_template"]).expanduser()
+    try:
+        text = _load_template(template).format_map(dict(
+            job_name=job_name,
+            nprocs=nprocs,
+            partition=opts["slurm_partition"],
+            mem=opts["slurm_mem"],
+            time=opts["slurm_time"],
+            account=opts["slurm_account"],
+            amber_env=opts["amber_env"],
+        ))
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(
+            f"cannot render SLURM template {template}: {e!r}. Placeholders are "
+            f"{{job_name}}, {{nprocs}}, {{partition}}, {{mem}}, {{time}}, {{account}}, "
+            f"{{amber_env}}; write literal braces (e.g. shell ${{VAR}}) as {{{{ }}}}."
+        ) from e
+    _write_bytes(out_path, text.encode())
     out_path.chmod(0o755)
 
 # ---------------------------
 # Pipeline
 # ---------------------------
 
+def prepare_cpptraj(work: Path, source_prmtop: Path, source_nc: str, data: Dict[str, Any],
+                    strip_procs: int = 1, force: bool = False):
+    """
+    Write the cpptraj inputs into work and run the sessions whose outputs are
+    stale: stripped complex/receptor/ligand prmtops and the stripped trajectory.
+    """
+    # cpptraj splits input lines on whitespace, and every path below is
+    # written into its inputs verbatim.
+    for path in (work, source_prmtop, source_nc):
+        if any(c.isspace() for c in str(path)):
+            raise ValueError(f"cpptraj cannot take paths containing whitespace: {path!s}")
+
+    # Strip expressions are built once and shared by every writer
+    complex_strip = strip_expr(data["complex_residues"])
+
+    # 1) Create stripped prmtops (one cpptraj session for all three)
+    write_cpptraj_all_prmtops_in(
+        work / "all_prmtops.in",
+        str(source_prmtop),
+        complex_strip,
+        strip_expr(data["receptor_residues"]),
+        strip_expr(data["ligand_residues"]),
+        out_dir=str(work),
+    )
+
+    # 2) Prepare stripped/autoimaged trajectory
+    start, end, interval = int(data["startframe"]), int(data["endframe"]), int(data["interval"])
+    nframes = expected_frames(start, end, interval)
+    if nframes is not None and nframes > _FRAME_WARN_THRESHOLD:
+        print(f"[warn] {nframes} frames selected ({start}-{end} every {interval}); "
+              f"consider a larger interval", file=sys.stderr)
+    compress = compress_level(data.get("traj_compress", False))
+    write_cpptraj_striptraj_in(
+        work / "strip_traj.in",
+        str(source_prmtop),
+        source_nc,
+        complex_strip,
+        start, end, interval,
+        str(work / "md.nc"),
+        compress=compress,
+    )
+    # cpptraj.MPI writes NetCDF in parallel through PnetCDF, which cannot
+    # produce compressed NetCDF4/HDF5, so compressed output stays serial.
+    if compress and strip_procs > 1:
+        print("[info] traj_compress is set; stripping the trajectory with serial cpptraj")
+        strip_procs = 1
+
+    # Sessions whose stamp matches (same rendered input, unchanged sources,
+    # outputs present) are skipped. Heavier traj strip goes first and is the
+    # only one worth spreading over MPI ranks (the prmtop strips are single-frame).
+    sessions = [
+        (work / "strip_traj.in", strip_procs,
+         [source_prmtop, Path(source_nc)], [work / "md.nc"]),
+        (work / "all_prmtops.in", 1, [source_prmtop],
+         [work / f"{tag}.prmtop" for tag in ("complex", "receptor", "ligand")]),
+    ]
+    stale = []
+    for in_path, nprocs, sources, outputs in sessions:
+        if not force and is_up_to_date(in_path, sources, outputs):
+            print(f"[skip] {in_path.name}: outputs up to date")
+            continue
+        clear_stamp(in_path)
+        stale.append((in_path, nprocs, sources))
+
+    # The cpptraj sessions only share the source files read-only and write
+    # disjoint outputs, so run them concurrently. Inputs use absolute paths and
+    # are launched without cwd so subprocess can posix_spawn them directly.
+    # They are deliberately not folded into one script: the extra topology
+    # parse is cheap next to the trajectory pass, while a merged session
+    # would serialize the prmtop writes behind it, push them through
+    # cpptraj.MPI, and make both outputs share one freshness stamp.
+    # Each stamp is written as soon as its own session succeeds, so a failed
+    # prmtop strip does not cost a finished trajectory strip its stamp.
+    if stale:
+        run_parallel([
+            (cpptraj_argv(str(in_path), nprocs), None,
+             functools.partial(write_stamp, in_path, sources))
+            for in_path, nprocs, sources in stale
+        ])
+        # Both trajectories are touched once here and never again on this node
+        # (MMPBSA runs under SLURM), so don't let them squat in page cache.
+        if any(in_path.name == "strip_traj.in" for in_path, _, _ in stale):
+            drop_page_cache(Path(source_nc))
+            drop_page_cache(work / "md.nc")
+
 def main():
     ap = argparse.ArgumentParser(description="Prepare and (optionally) run (QMMM-)MMGBSA from JSON.")
     ap.add_argument("-i", "--input", required=True, help="Path to JSON config.")
     ap.add_argument("--procs", type=int, default=16, help="MPI ranks for MMPBSA.py.MPI")
     ap.add_argument("--dry-run", action="store_true", help="Prepare everything but do not submit.")
+    ap.add_argument("--strip-procs", type=int, default=min(4, os.cpu_count() or 1),
+                    help="MPI ranks for the trajectory strip when cpptraj.MPI is available")
+    ap.add_argument("--force", action="store_true",
+                    help="Re-run cpptraj even if its outputs are up to date.")
     args = ap.parse_args()
 
     # Load config
-    with open(args.input, "r") as f:
-        data = json.load(f)
+    data = _json_loads(Path(args.input).read_bytes())
 
     # Basic validation
-    require_keys(data, [
-        "directory", "complex_residues", "receptor_residues", "ligand_residues",
-        "level_of_theory", "startframe", "endframe", "interval",
-        "igb", "saltcon", "submit_job"
-    ])
+    require_keys(data, _BASE_KEYS)
     level = str(data["level_of_theory"]).upper()
     if level != "MM":
-        require_keys(data, ["qm_residues", "qmcharge_com", "qmcharge_rec", "qmcharge_lig"])
+        require_keys(data, _QM_KEYS)
+
+    submit = coerce_bool(data["submit_job"]) and not args.dry_run
 
     # External tool checks (fail early with a helpful error)
     ensure_cmd("cpptraj")
+    if submit:
+        ensure_cmd("sbatch")
     # MMPBSA.py.MPI path is resolved inside the SLURM job via $AMBERHOME
 
     # Resolve paths
@@ -197,40 +520,21 @@ def main():
     if not sim_dir.exists():
         raise FileNotFoundError(f"directory not found: {sim_dir}")
 
-    # Identify a prmtop to load in cpptraj (use glob, as per your original approach)
-    # We'll pass the glob string directly to cpptraj, matching your pipeline.
-    prmtop_glob = str(sim_dir / "*.prmtop")
+    # Identify the (single) solvated prmtop to load in cpptraj
+    source_prmtop = pick_single_file(sim_dir, "*.prmtop")
 
     # Output workspace: <prefix> alongside this script / CWD
     prefix = sim_dir.name + "_gbsa"
     work = Path.cwd() / prefix
     work.mkdir(parents=True, exist_ok=True)
 
-    # 1) Create stripped prmtops
-    write_cpptraj_prmtop_in(work / "complex_prmtop.in", prmtop_glob, data["complex_residues"], "./complex.prmtop")
-    write_cpptraj_prmtop_in(work / "receptor_prmtop.in", prmtop_glob, data["receptor_residues"], "./receptor.prmtop")
-    write_cpptraj_prmtop_in(work / "ligand_prmtop.in",  prmtop_glob, data["ligand_residues"],  "./ligand.prmtop")
-
-    run("cpptraj -i complex_prmtop.in", cwd=work)
-    run("cpptraj -i receptor_prmtop.in", cwd=work)
-    run("cpptraj -i ligand_prmtop.in",  cwd=work)
-
-    # 2) Prepare stripped/autoimaged trajectory
     source_nc = str(sim_dir / "md.nc")
     if not Path(source_nc).exists():
         raise FileNotFoundError(f"Trajectory not found: {source_nc}")
 
-    write_cpptraj_striptraj_in(
-        work / "strip_traj.in",
-        prmtop_glob,
-        source_nc,
-        data["complex_residues"],
-        int(data["startframe"]),
-        int(data["endframe"]),
-        int(data["interval"]),
-        "./md.nc",
-    )
-    run("cpptraj -i strip_traj.in", cwd=work)
+    # 1-2) Stripped prmtops + trajectory (up-to-date sessions are skipped)
+    prepare_cpptraj(work, source_prmtop, source_nc, data,
+                    strip_procs=args.strip_procs, force=args.force)
 
     # 3) Prepare MMPBSA input + job dir
     mmgbsa_dirname = f"{level}gbsa"   # e.g., MMgbsa or PM6gbsa
@@ -242,14 +546,15 @@ def main():
 
     # 4) SLURM script (inside mmgbsa_dir)
     job_script = mmgbsa_dir / "submit.job"
-    write_slurm_job(job_script, job_name=prefix, nprocs=args.procs)
+    write_slurm_job(job_script, job_name=prefix, nprocs=args.procs, data=data,
+                    config_dir=Path(args.input).resolve().parent)
 
     # 5) Optionally submit
-    submit = coerce_bool(data["submit_job"])
-    if submit and not args.dry_run:
-        ensure_cmd("sbatch")
-        run("sbatch submit.job", cwd=mmgbsa_dir)
-        print(f"\nSubmitted: {job_script}")
+    if submit:
+        job_id = _submit_sbatch("submit.job", cwd=mmgbsa_dir)
+        _write_bytes(mmgbsa_dir / ".jobid", f"{job_id}\n".encode())
+        print(f"\nSubmitted: {job_script} (job {job_id})")
+        print(f"Check status:\n  squeue -j {job_id}")
     else:
         print("\nPreparation complete.")
         print(f"To run later:\n  (cd {mmgbsa_dir} && sbatch submit.job)")